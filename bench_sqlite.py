@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+# Сравнение старого пути (новое соединение на операцию, DELETE + FULL)
+# с долгоживущими соединениями SQLiteManager в режимах DELETE и WAL.
+# Старый путь блокирует цикл событий на каждом вызове — так и было.
+#
+#   python bench_sqlite.py [клики] [циклы] [строк за цикл]
+import asyncio
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+
+from bot import SQLiteManager
+
+
+def legacy_conn(path: str) -> sqlite3.Connection:
+    conn = sqlite3.connect(path, timeout=30)
+    conn.execute("PRAGMA journal_mode=DELETE;")
+    conn.execute("PRAGMA synchronous=FULL;")
+    conn.execute("PRAGMA foreign_keys=ON;")
+    return conn
+
+
+class LegacyDB:
+    # Повторяет поведение до SQLiteManager: open/PRAGMA/commit/close
+    def __init__(self, path: str):
+        self.path = path
+
+    async def write(self, sql, params=(), many=False):
+        conn = legacy_conn(self.path)
+        if many:
+            conn.executemany(sql, params)
+        else:
+            conn.execute(sql, params)
+        conn.commit()
+        conn.close()
+
+    async def read(self, sql, params=()):
+        conn = legacy_conn(self.path)
+        rows = conn.execute(sql, params).fetchall()
+        conn.close()
+        return rows
+
+    async def close(self):
+        pass
+
+
+class ManagedDB:
+    def __init__(self, path: str, wal: bool):
+        self.manager = SQLiteManager(path, wal=wal)
+
+    async def write(self, sql, params=(), many=False):
+        async with self.manager.writer() as conn:
+            if many:
+                await conn.executemany(sql, params)
+            else:
+                await conn.execute(sql, params)
+
+    async def read(self, sql, params=()):
+        async with self.manager.reader() as conn:
+            return await conn.execute_fetchall(sql, params)
+
+    async def close(self):
+        await self.manager.close()
+
+
+async def run(db, clicks: int, cycles: int, rows: int):
+    await db.write("CREATE TABLE subscribers (chat_id INTEGER PRIMARY KEY)")
+    await db.write("""
+        CREATE TABLE orders (
+            row_index INTEGER PRIMARY KEY,
+            hash BLOB NOT NULL,
+            line TEXT NOT NULL
+        )
+    """)
+
+    t0 = time.perf_counter()
+    for chat_id in range(clicks):
+        await db.write("INSERT OR IGNORE INTO subscribers(chat_id) VALUES(?)", (chat_id,))
+        await db.read("SELECT chat_id FROM subscribers")
+        await db.write("DELETE FROM subscribers WHERE chat_id=?", (chat_id,))
+    t_clicks = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    for cycle in range(cycles):
+        batch = [
+            (idx, os.urandom(8), f"cycle {cycle} row {idx}")
+            for idx in range(1, rows + 1)
+        ]
+        await db.write(
+            "INSERT OR REPLACE INTO orders(row_index, hash, line) VALUES(?,?,?)",
+            batch,
+            many=True,
+        )
+    t_cycles = time.perf_counter() - t0
+
+    await db.close()
+    return t_clicks, t_cycles
+
+
+def main():
+    clicks = int(sys.argv[1]) if len(sys.argv) > 1 else 300
+    cycles = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+    rows = int(sys.argv[3]) if len(sys.argv) > 3 else 1000
+
+    modes = [
+        ("legacy DELETE/FULL", lambda p: LegacyDB(p)),
+        ("manager DELETE/FULL", lambda p: ManagedDB(p, wal=False)),
+        ("manager WAL/NORMAL", lambda p: ManagedDB(p, wal=True)),
+    ]
+
+    print(f"{clicks} subscribe clicks, {cycles} poll commits x {rows} rows")
+    for name, factory in modes:
+        with tempfile.TemporaryDirectory() as tmp:
+            t_clicks, t_cycles = asyncio.run(
+                run(factory(os.path.join(tmp, "bench.db")), clicks, cycles, rows)
+            )
+        print(
+            f"{name:22} clicks: {t_clicks / clicks * 1000:7.3f} ms/click   "
+            f"commits: {t_cycles / cycles * 1000:7.3f} ms/cycle"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -3,14 +3,20 @@ import asyncio
 import hashlib
 import logging
 import re
-import sqlite3
 import time
-import requests
 import os
 import json
-
-import gspread
-from oauth2client.service_account import ServiceAccountCredentials
+import random
+from contextlib import asynccontextmanager
+from collections import OrderedDict, deque
+from urllib.parse import quote, urlsplit, urlunsplit
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache, partial
+
+import aiohttp
+import aiosqlite
+from aiohttp import web
+from oauth2client import crypt
 from aiogram import Bot, Dispatcher, types
 from aiogram.filters import Command
 from aiogram.types import (
@@ -19,7 +25,11 @@ from aiogram.types import (
     InlineKeyboardMarkup,
     InlineKeyboardButton,
 )
-from aiogram.exceptions import TelegramRetryAfter
+from aiogram.exceptions import (
+    TelegramBadRequest,
+    TelegramForbiddenError,
+    TelegramRetryAfter,
+)
 
 # -------------------------------------------------
 # ЛОГИ
@@ -32,84 +42,471 @@ logger = logging.getLogger(__name__)
 # -------------------------------------------------
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 SHEET_ID = os.getenv("SHEET_ID")
+# Пусто — первый лист таблицы
+SHEET_NAME = os.getenv("SHEET_NAME", "")
 SERVICE_ACCOUNT_JSON = os.getenv("SERVICE_ACCOUNT_JSON")
 
 POLL_INTERVAL = int(os.getenv("POLL_INTERVAL", "10"))
 NOTIFY_DELAY = int(os.getenv("NOTIFY_DELAY", "2"))
 
+# Доставка из outbox: период опроса и сколько заданий брать за раз
+DELIVERY_INTERVAL = float(os.getenv("DELIVERY_INTERVAL", "1"))
+DELIVERY_BATCH = int(os.getenv("DELIVERY_BATCH", "1000"))
+
+# Повторы неудачных отправок: экспоненциальная задержка, с, и её потолок
+DELIVERY_RETRY_BASE = float(os.getenv("DELIVERY_RETRY_BASE", "5"))
+DELIVERY_RETRY_MAX = float(os.getenv("DELIVERY_RETRY_MAX", "3600"))
+
+# Токен сервисного аккаунта живёт час, обновляем заранее
+SHEETS_TOKEN_TTL = int(os.getenv("SHEETS_TOKEN_TTL", "3600"))
+SHEETS_TOKEN_MARGIN = int(os.getenv("SHEETS_TOKEN_MARGIN", "300"))
+
+# Пул потоков для разбора листа и лимит одновременных загрузок
+SHEETS_WORKERS = int(os.getenv("SHEETS_WORKERS", "2"))
+SHEETS_CONCURRENCY = int(os.getenv("SHEETS_CONCURRENCY", "1"))
+
+# Общий пул HTTP-соединений (keep-alive)
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", "20"))
+HTTP_KEEPALIVE = int(os.getenv("HTTP_KEEPALIVE", "60"))
+HTTP_TIMEOUT = int(os.getenv("HTTP_TIMEOUT", "30"))
+
+# Таймаут запроса к сокращателю ссылок, с
+SHORTENER_TIMEOUT = float(os.getenv("SHORTENER_TIMEOUT", "7"))
+
+# Сокращатели по приоритету через запятую: clck, isgd, tinyurl,
+# local (свой, с редирект-сервером).
+# SHORTENER_BASE_URL — внешний адрес редирект-сервера, например https://s.example.com
+SHORTENER_BACKENDS = [
+    b.strip()
+    for b in os.getenv("SHORTENER_BACKENDS", "clck,isgd").split(",")
+    if b.strip()
+]
+SHORTENER_BASE_URL = os.getenv("SHORTENER_BASE_URL", "")
+SHORTENER_HOST = os.getenv("SHORTENER_HOST", "0.0.0.0")
+SHORTENER_PORT = int(os.getenv("PORT", "8080"))
+LOCAL_LINKS_HOT = int(os.getenv("LOCAL_LINKS_HOT", "10000"))
+
+# Circuit breaker: после N ошибок подряд сокращатель пропускается
+# на SHORTENER_COOLDOWN с, затем пробуется одним запросом
+SHORTENER_FAILURES = int(os.getenv("SHORTENER_FAILURES", "3"))
+SHORTENER_COOLDOWN = float(os.getenv("SHORTENER_COOLDOWN", "60"))
+
+# Хеджирование: если сокращатель не ответил за p95 своих последних
+# задержек, параллельно запускается следующий. Пока замеров меньше
+# SHORTENER_HEDGE_SAMPLES, ждём SHORTENER_HEDGE_DELAY с
+SHORTENER_HEDGE_DELAY = float(os.getenv("SHORTENER_HEDGE_DELAY", "1.0"))
+SHORTENER_HEDGE_MIN = float(os.getenv("SHORTENER_HEDGE_MIN", "0.05"))
+SHORTENER_HEDGE_SAMPLES = int(os.getenv("SHORTENER_HEDGE_SAMPLES", "20"))
+SHORTENER_LATENCY_WINDOW = int(os.getenv("SHORTENER_LATENCY_WINDOW", "200"))
+
+# Кэш коротких ссылок: записей в памяти, срок жизни (с),
+# записей в links.db и как часто чистить таблицу (раз в N записей)
+LINK_CACHE_SIZE = int(os.getenv("LINK_CACHE_SIZE", "10000"))
+LINK_CACHE_TTL = int(os.getenv("LINK_CACHE_TTL", str(30 * 86400)))
+LINK_CACHE_DB_ROWS = int(os.getenv("LINK_CACHE_DB_ROWS", "200000"))
+LINK_CACHE_EVICT_EVERY = 100
+
+# Пропускать цикл, если таблица не менялась с прошлой обработки
+CHANGE_DETECTION = os.getenv("CHANGE_DETECTION", "1") == "1"
+
+# Режим хвоста: читать только строки после последней известной,
+# полная сверка — раз в FULL_SYNC_EVERY циклов опроса, даже если
+# версия таблицы не менялась (хвост не видит правок старых строк)
+TAIL_MODE = os.getenv("TAIL_MODE", "0") == "1"
+FULL_SYNC_EVERY = int(os.getenv("FULL_SYNC_EVERY", "30"))
+
+# Размер блока строк для дерева хешей
+MERKLE_BLOCK_ROWS = int(os.getenv("MERKLE_BLOCK_ROWS", "256"))
+
+# Дайджест строк: blake2b-8, blake2b-16 или sha256.
+# При смене хеши в orders.db пересчитываются на старте.
+ROW_DIGEST = os.getenv("ROW_DIGEST", "blake2b-8")
+
 DB_ORDERS = "orders.db"
 DB_SUBS = "subs.db"
+DB_LINKS = "links.db"
+
+# SQLite: WAL + synchronous=NORMAL вместо DELETE + FULL (по желанию),
+# размер пула читателей и кэша подготовленных выражений
+SQLITE_WAL = os.getenv("SQLITE_WAL", "0") == "1"
+SQLITE_READERS = int(os.getenv("SQLITE_READERS", "4"))
+SQLITE_STMT_CACHE = int(os.getenv("SQLITE_STMT_CACHE", "256"))
 
 MAX_COLS = 25
 MAX_MESSAGE_LENGTH = 4000
 
+# Куда слать заказы: dm, channel или hybrid (канал + личные сообщения)
+DELIVERY_MODE = os.getenv("DELIVERY_MODE", "dm")
+BROADCAST_CHAT_ID = int(os.getenv("BROADCAST_CHAT_ID", "0"))
+BROADCAST_CHAT_RATE = float(os.getenv("BROADCAST_CHAT_RATE", "0.33"))
+INVITE_LINK_TTL = int(os.getenv("INVITE_LINK_TTL", "86400"))
+
+# Склеивать несколько заказов в одно сообщение подписчику
+BATCH_MESSAGES = os.getenv("BATCH_MESSAGES", "0") == "1"
+PACK_SEPARATOR = "\n\n"
+
+# Обновления заказа правят уже отправленное сообщение,
+# если оно моложе EDIT_WINDOW секунд (0 — всегда новое сообщение)
+EDIT_WINDOW = int(os.getenv("EDIT_WINDOW", "0"))
+
+# Место под метку продолжения "(2/3)" в длинных сообщениях
+CHUNK_MARKER_RESERVE = 16
+
+# Рассылка: общий лимит бота, лимит на чат (сообщений/с)
+# и число одновременных запросов к Telegram
+SEND_GLOBAL_RATE = float(os.getenv("SEND_GLOBAL_RATE", "30"))
+SEND_CHAT_RATE = float(os.getenv("SEND_CHAT_RATE", "1"))
+SEND_CONCURRENCY = int(os.getenv("SEND_CONCURRENCY", "30"))
+
+# После RetryAfter: сколько раз повторять и разброс старта после паузы, с
+SEND_MAX_RETRIES = int(os.getenv("SEND_MAX_RETRIES", "3"))
+SEND_RETRY_JITTER = float(os.getenv("SEND_RETRY_JITTER", "1"))
+
 # Тихий старт
 FIRST_RUN = True
 
+# Последняя обработанная версия таблицы (Drive version, modifiedTime)
+SHEET_VERSION = None
+
+# Циклов опроса с последней полной сверки
+TAIL_CYCLES = 0
+
 # -------------------------------------------------
-# SQLITE HELPERS (БЕЗ WAL ❗)
+# SQLITE HELPERS (WAL — только по SQLITE_WAL=1)
 # -------------------------------------------------
-def get_conn(path: str) -> sqlite3.Connection:
-    conn = sqlite3.connect(path, timeout=30)
-    conn.execute("PRAGMA journal_mode=DELETE;")
-    conn.execute("PRAGMA synchronous=FULL;")
-    conn.execute("PRAGMA foreign_keys=ON;")
-    return conn
-
-
-def init_db_orders():
-    conn = get_conn(DB_ORDERS)
-    c = conn.cursor()
-
-    c.execute("""
-        CREATE TABLE IF NOT EXISTS orders (
-            row_index INTEGER PRIMARY KEY,
-            hash TEXT NOT NULL,
-            line TEXT NOT NULL,
-            updated_at REAL DEFAULT (strftime('%s','now'))
+class SQLiteManager:
+    # Одно долгоживущее соединение на запись и пул читателей на базу.
+    # Каждое соединение aiosqlite работает в своём потоке, так что
+    # fsync при коммите не останавливает цикл событий.
+    def __init__(self, path: str, wal: bool = SQLITE_WAL, readers: int = SQLITE_READERS):
+        self.path = path
+        self.wal = wal
+        self._writer = None
+        self._write_lock = asyncio.Lock()
+        self._readers = []
+        # Читателей не больше readers: остальные ждут свободное соединение,
+        # а не открывают новое
+        self._reader_slots = asyncio.Semaphore(max(1, readers))
+
+    async def _connect(self) -> aiosqlite.Connection:
+        conn = await aiosqlite.connect(
+            self.path,
+            timeout=30,
+            cached_statements=SQLITE_STMT_CACHE,
         )
-    """)
-
-    c.execute("""
-        CREATE TABLE IF NOT EXISTS pending (
-            row_index INTEGER PRIMARY KEY,
-            hash TEXT NOT NULL,
-            line TEXT NOT NULL,
-            ts REAL NOT NULL,
-            is_new INTEGER NOT NULL
+        if self.wal:
+            await conn.execute("PRAGMA journal_mode=WAL;")
+            await conn.execute("PRAGMA synchronous=NORMAL;")
+        else:
+            await conn.execute("PRAGMA journal_mode=DELETE;")
+            await conn.execute("PRAGMA synchronous=FULL;")
+        await conn.execute("PRAGMA foreign_keys=ON;")
+        return conn
+
+    @asynccontextmanager
+    async def writer(self):
+        async with self._write_lock:
+            if self._writer is None:
+                self._writer = await self._connect()
+            try:
+                yield self._writer
+                await self._writer.commit()
+            except BaseException:
+                await self._writer.rollback()
+                raise
+
+    @asynccontextmanager
+    async def reader(self):
+        async with self._reader_slots:
+            if self._readers:
+                conn = self._readers.pop()
+            else:
+                conn = await self._connect()
+            try:
+                yield conn
+            finally:
+                self._readers.append(conn)
+
+    async def close(self):
+        async with self._write_lock:
+            if self._writer is not None:
+                await self._writer.close()
+                self._writer = None
+        while self._readers:
+            await self._readers.pop().close()
+
+
+orders_db = SQLiteManager(DB_ORDERS)
+subs_db = SQLiteManager(DB_SUBS)
+links_db = SQLiteManager(DB_LINKS)
+
+
+async def init_db_orders():
+    async with orders_db.writer() as conn:
+        await conn.execute("""
+            CREATE TABLE IF NOT EXISTS orders (
+                row_index INTEGER PRIMARY KEY,
+                hash BLOB NOT NULL,
+                line TEXT NOT NULL,
+                updated_at REAL DEFAULT (strftime('%s','now'))
+            )
+        """)
+
+        await conn.execute("""
+            CREATE TABLE IF NOT EXISTS pending (
+                row_index INTEGER PRIMARY KEY,
+                hash BLOB NOT NULL,
+                line TEXT NOT NULL,
+                ts REAL NOT NULL,
+                is_new INTEGER NOT NULL
+            )
+        """)
+
+        await conn.execute("""
+            CREATE TABLE IF NOT EXISTS order_blocks (
+                block_index INTEGER PRIMARY KEY,
+                digest BLOB NOT NULL
+            )
+        """)
+
+        await conn.execute("""
+            CREATE TABLE IF NOT EXISTS meta (
+                key TEXT PRIMARY KEY,
+                value
+            )
+        """)
+
+        await conn.execute("""
+            CREATE TABLE IF NOT EXISTS outbox (
+                row_index INTEGER NOT NULL,
+                chat_id INTEGER NOT NULL,
+                hash BLOB NOT NULL,
+                line TEXT NOT NULL,
+                is_new INTEGER NOT NULL,
+                ts REAL NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                next_at REAL NOT NULL DEFAULT 0,
+                parts_sent INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (row_index, chat_id)
+            )
+        """)
+        await add_missing_columns(conn, "outbox", {
+            "attempts": "INTEGER NOT NULL DEFAULT 0",
+            "next_at": "REAL NOT NULL DEFAULT 0",
+            "parts_sent": "INTEGER NOT NULL DEFAULT 0",
+        })
+
+        await conn.execute("""
+            CREATE TABLE IF NOT EXISTS sent_messages (
+                row_index INTEGER NOT NULL,
+                chat_id INTEGER NOT NULL,
+                message_id INTEGER NOT NULL,
+                is_new INTEGER NOT NULL,
+                sent_at REAL NOT NULL,
+                PRIMARY KEY (row_index, chat_id)
+            )
+        """)
+        await conn.execute("""
+            CREATE INDEX IF NOT EXISTS sent_messages_sent_at
+            ON sent_messages(sent_at)
+        """)
+
+        await migrate_row_digest(conn)
+
+
+async def add_missing_columns(conn: aiosqlite.Connection, table: str, columns):
+    info = await conn.execute_fetchall(f"PRAGMA table_info({table})")
+    existing = {r[1] for r in info}
+    for name, ddl in columns.items():
+        if name not in existing:
+            await conn.execute(f"ALTER TABLE {table} ADD COLUMN {name} {ddl}")
+
+
+async def migrate_row_digest(conn: aiosqlite.Connection):
+    res = await conn.execute_fetchall(
+        "SELECT value FROM meta WHERE key='row_digest'"
+    )
+    # Старые базы хранили sha256 в hex
+    current = res[0][0] if res else "sha256-hex"
+    if current == ROW_DIGEST:
+        return
+
+    for table in ("orders", "pending", "outbox"):
+        rows = await conn.execute_fetchall(f"SELECT row_index, line FROM {table}")
+        await conn.executemany(
+            f"UPDATE {table} SET hash=? WHERE row_index=?",
+            [(make_hash(line), idx) for idx, line in rows],
         )
-    """)
-
-    conn.commit()
-    conn.close()
 
-
-def init_db_subs():
-    conn = get_conn(DB_SUBS)
-    c = conn.cursor()
-    c.execute("""
-        CREATE TABLE IF NOT EXISTS subscribers (
-            chat_id INTEGER PRIMARY KEY
-        )
-    """)
-    conn.commit()
-    conn.close()
+    # Хеши блоков считаются тем же дайджестом — пусть пересоберутся
+    await conn.execute("DELETE FROM order_blocks")
+    await conn.execute("DELETE FROM meta WHERE key='merkle_root'")
+    await conn.execute(
+        "INSERT OR REPLACE INTO meta(key, value) VALUES('row_digest', ?)",
+        (ROW_DIGEST,),
+    )
+    logger.info(f"row digests migrated: {current} -> {ROW_DIGEST}")
+
+
+async def init_db_links():
+    async with links_db.writer() as conn:
+        await conn.execute("""
+            CREATE TABLE IF NOT EXISTS short_links (
+                long_url TEXT PRIMARY KEY,
+                short_url TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                used_at REAL NOT NULL
+            )
+        """)
+        await conn.execute("""
+            CREATE INDEX IF NOT EXISTS short_links_used_at
+            ON short_links(used_at)
+        """)
+
+        await conn.execute("""
+            CREATE TABLE IF NOT EXISTS local_links (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                long_url TEXT NOT NULL UNIQUE,
+                created_at REAL NOT NULL
+            )
+        """)
+
+
+async def init_db_subs():
+    async with subs_db.writer() as conn:
+        await conn.execute("""
+            CREATE TABLE IF NOT EXISTS subscribers (
+                chat_id INTEGER PRIMARY KEY
+            )
+        """)
 
 
 # -------------------------------------------------
 # GOOGLE SHEETS
 # -------------------------------------------------
-def get_sheet():
-    scope = [
-        "https://spreadsheets.google.com/feeds",
-        "https://www.googleapis.com/auth/spreadsheets",
-        "https://www.googleapis.com/auth/drive",
-    ]
-    creds_dict = json.loads(SERVICE_ACCOUNT_JSON)
-    creds = ServiceAccountCredentials.from_json_keyfile_dict(creds_dict, scope)
-    client = gspread.authorize(creds)
-    doc = client.open_by_key(SHEET_ID)
-    return doc.get_worksheet(0)
+SHEETS_SCOPE = [
+    "https://www.googleapis.com/auth/spreadsheets.readonly",
+    "https://www.googleapis.com/auth/drive.readonly",
+]
+SHEETS_API = "https://sheets.googleapis.com/v4/spreadsheets"
+DRIVE_FILES_API = "https://www.googleapis.com/drive/v3/files"
+GOOGLE_TOKEN_URI = "https://oauth2.googleapis.com/token"
+JWT_GRANT_TYPE = "urn:ietf:params:oauth:grant-type:jwt-bearer"
+
+# Ошибки, после которых токен запрашивается заново
+SHEETS_REBUILD_STATUSES = (401, 403, 404)
+
+
+def col_letter(n: int) -> str:
+    s = ""
+    while n:
+        n, r = divmod(n - 1, 26)
+        s = chr(ord("A") + r) + s
+    return s
+
+
+LAST_COL = col_letter(MAX_COLS)
+
+
+def sheet_range(a1: str) -> str:
+    if SHEET_NAME:
+        return "'" + SHEET_NAME.replace("'", "''") + "'!" + a1
+    return a1
+
+
+class SheetsClient:
+    def __init__(self, session: aiohttp.ClientSession):
+        self._session = session
+        self._info = None
+        self._signer = None
+        self._token = None
+        self._token_exp = 0.0
+        self._lock = asyncio.Lock()
+
+    def invalidate(self):
+        self._token = None
+        self._token_exp = 0.0
+
+    def handle_error(self, e: Exception):
+        if isinstance(e, aiohttp.ClientResponseError):
+            if e.status in SHEETS_REBUILD_STATUSES:
+                self.invalidate()
+
+    async def _access_token(self) -> str:
+        if self._token and time.time() < self._token_exp - SHEETS_TOKEN_MARGIN:
+            return self._token
+        async with self._lock:
+            if self._token and time.time() < self._token_exp - SHEETS_TOKEN_MARGIN:
+                return self._token
+            await self._refresh_token()
+            return self._token
+
+    async def _refresh_token(self):
+        if self._info is None:
+            self._info = json.loads(SERVICE_ACCOUNT_JSON)
+            self._signer = crypt.Signer.from_string(self._info["private_key"])
+
+        token_uri = self._info.get("token_uri", GOOGLE_TOKEN_URI)
+        now = int(time.time())
+        payload = {
+            "iss": self._info["client_email"],
+            "scope": " ".join(SHEETS_SCOPE),
+            "aud": token_uri,
+            "iat": now,
+            "exp": now + SHEETS_TOKEN_TTL,
+        }
+        assertion = crypt.make_signed_jwt(
+            self._signer,
+            payload,
+            key_id=self._info.get("private_key_id"),
+        )
+        async with self._session.post(
+            token_uri,
+            data={"grant_type": JWT_GRANT_TYPE, "assertion": assertion.decode()},
+        ) as r:
+            r.raise_for_status()
+            data = await r.json()
+
+        self._token = data["access_token"]
+        self._token_exp = time.time() + int(data.get("expires_in", SHEETS_TOKEN_TTL))
+        logger.info("Sheets token refreshed")
+
+    async def _get(self, url: str, params=None):
+        token = await self._access_token()
+        headers = {"Authorization": f"Bearer {token}"}
+        async with self._session.get(url, params=params, headers=headers) as r:
+            r.raise_for_status()
+            return await r.json()
+
+    async def file_version(self):
+        data = await self._get(
+            f"{DRIVE_FILES_API}/{SHEET_ID}",
+            params={"fields": "version,modifiedTime", "supportsAllDrives": "true"},
+        )
+        return data.get("version"), data.get("modifiedTime")
+
+    async def values_get(self, a1: str):
+        url = f"{SHEETS_API}/{SHEET_ID}/values/{quote(sheet_range(a1), safe='')}"
+        data = await self._get(url, params={"majorDimension": "ROWS"})
+        return data.get("values", [])
+
+    async def values_batch_get(self, ranges):
+        params = [("majorDimension", "ROWS")]
+        params += [("ranges", sheet_range(a1)) for a1 in ranges]
+        data = await self._get(f"{SHEETS_API}/{SHEET_ID}/values:batchGet", params)
+        return [vr.get("values", []) for vr in data.get("valueRanges", [])]
+
+
+def create_http_session() -> aiohttp.ClientSession:
+    connector = aiohttp.TCPConnector(
+        limit=HTTP_POOL_SIZE,
+        keepalive_timeout=HTTP_KEEPALIVE,
+    )
+    return aiohttp.ClientSession(
+        connector=connector,
+        timeout=aiohttp.ClientTimeout(total=HTTP_TIMEOUT),
+        headers={"User-Agent": "anothertestingbot (gzip)"},
+    )
 
 
 # -------------------------------------------------
@@ -124,143 +521,937 @@ def make_line(row):
     return " | ".join(parts)
 
 
-def make_hash(line: str) -> str:
-    return hashlib.sha256(line.encode("utf-8")).hexdigest()
+ROW_DIGESTS = {
+    "blake2b-8": partial(hashlib.blake2b, digest_size=8),
+    "blake2b-16": partial(hashlib.blake2b, digest_size=16),
+    "sha256": hashlib.sha256,
+}
+new_digest = ROW_DIGESTS[ROW_DIGEST]
+DIGEST_SIZE = new_digest().digest_size
+
+
+def make_hash(line: str) -> bytes:
+    return new_digest(line.encode("utf-8")).digest()
 
 
 def is_url(text: str) -> bool:
     return bool(re.match(r"^https?://", text or ""))
 
 
-def shorten_clck(long_url: str) -> str:
+# -------------------------------------------------
+# СОКРАЩЕНИЕ ССЫЛОК
+# -------------------------------------------------
+DEFAULT_PORTS = {"http": 80, "https": 443}
+
+
+def normalize_url(url: str) -> str:
+    # Ключ кэша: регистр схемы и хоста, порт по умолчанию и пустой путь
+    # не меняют адрес. Наружу уходит исходная ссылка, не ключ
+    url = url.strip()
+    parts = urlsplit(url)
     try:
-        r = requests.get(
-            "https://clck.ru/--",
-            params={"url": long_url},
-            timeout=7,
+        port = parts.port
+    except ValueError:
+        return url
+    scheme = parts.scheme.lower()
+    host = (parts.hostname or "").lower()
+    if ":" in host:
+        # hostname теряет скобки IPv6-адреса
+        host = f"[{host}]"
+    if port and DEFAULT_PORTS.get(scheme) != port:
+        host = f"{host}:{port}"
+    if parts.username or parts.password:
+        host = parts.netloc.rsplit("@", 1)[0] + "@" + host
+    return urlunsplit((scheme, host, parts.path or "/", parts.query, parts.fragment))
+
+
+class LinkCache:
+    # Два уровня: LRU в памяти и таблица short_links в links.db, оба с TTL
+    def __init__(self, size: int, ttl: int, max_rows: int):
+        self.size = size
+        self.ttl = ttl
+        self.max_rows = max_rows
+        self._lru = OrderedDict()
+        self._writes = 0
+
+    async def get(self, key: str):
+        now = time.time()
+        hit = self._lru.get(key)
+        if hit is not None:
+            short, created_at = hit
+            if now - created_at < self.ttl:
+                self._lru.move_to_end(key)
+                return short
+            del self._lru[key]
+
+        async with links_db.reader() as conn:
+            rows = await conn.execute_fetchall(
+                "SELECT short_url, created_at FROM short_links WHERE long_url=?",
+                (key,),
+            )
+        if not rows or now - rows[0][1] >= self.ttl:
+            return None
+
+        short, created_at = rows[0]
+        self._remember(key, short, created_at)
+        async with links_db.writer() as conn:
+            await conn.execute(
+                "UPDATE short_links SET used_at=? WHERE long_url=?",
+                (now, key),
+            )
+        return short
+
+    async def put(self, key: str, short: str):
+        now = time.time()
+        self._remember(key, short, now)
+        async with links_db.writer() as conn:
+            await conn.execute(
+                """
+                INSERT OR REPLACE INTO short_links
+                (long_url, short_url, created_at, used_at)
+                VALUES (?,?,?,?)
+                """,
+                (key, short, now, now),
+            )
+            self._writes += 1
+            if self._writes % LINK_CACHE_EVICT_EVERY == 0:
+                await self._evict(conn, now)
+
+    def _remember(self, key: str, short: str, created_at: float):
+        self._lru[key] = (short, created_at)
+        self._lru.move_to_end(key)
+        while len(self._lru) > self.size:
+            self._lru.popitem(last=False)
+
+    async def _evict(self, conn: aiosqlite.Connection, now: float):
+        await conn.execute(
+            "DELETE FROM short_links WHERE created_at < ?",
+            (now - self.ttl,),
         )
-        if r.status_code == 200:
-            return r.text.strip()
-        return f"Ошибка HTTP {r.status_code}"
-    except Exception as e:
-        return f"Ошибка: {e}"
+        await conn.execute(
+            """
+            DELETE FROM short_links WHERE long_url IN (
+                SELECT long_url FROM short_links
+                ORDER BY used_at DESC
+                LIMIT -1 OFFSET ?
+            )
+            """,
+            (self.max_rows,),
+        )
+
+
+# Публичные сокращатели: адрес и постоянные параметры запроса.
+# Все отвечают короткой ссылкой простым текстом
+HTTP_SHORTENERS = {
+    "clck": ("https://clck.ru/--", {}),
+    "isgd": ("https://is.gd/create.php", {"format": "simple"}),
+    "tinyurl": ("https://tinyurl.com/api-create.php", {}),
+}
+
+
+class HttpBackend:
+    def __init__(self, name: str, session: aiohttp.ClientSession):
+        self.name = name
+        self._url, self._params = HTTP_SHORTENERS[name]
+        self._session = session
+
+    async def shorten(self, long_url: str) -> str:
+        try:
+            async with self._session.get(
+                self._url,
+                params={**self._params, "url": long_url},
+                timeout=aiohttp.ClientTimeout(total=SHORTENER_TIMEOUT),
+            ) as r:
+                if r.status == 200:
+                    return (await r.text()).strip()
+                return f"Ошибка HTTP {r.status}"
+        except asyncio.TimeoutError:
+            return "Ошибка: таймаут"
+        except Exception as e:
+            return f"Ошибка: {e}"
+
+
+BASE62 = "0123456789abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ"
+
+
+def base62_encode(n: int) -> str:
+    s = ""
+    while True:
+        n, r = divmod(n, 62)
+        s = BASE62[r] + s
+        if not n:
+            return s
+
+
+# Самый большой INTEGER PRIMARY KEY в SQLite
+SQLITE_MAX_ID = 2 ** 63 - 1
+
+
+def base62_decode(code: str) -> int:
+    n = 0
+    for ch in code:
+        n = n * 62 + BASE62.index(ch)
+    return n
+
+
+class LocalBackend:
+    # Свой сокращатель: id из последовательности SQLite в base62
+    # и редирект-сервер на aiohttp с горячим кэшем в памяти
+    name = "local"
+
+    def __init__(self, base_url: str):
+        self.base_url = base_url.rstrip("/")
+        self._hot = OrderedDict()
+        self._runner = None
+
+    async def shorten(self, long_url: str) -> str:
+        try:
+            async with links_db.writer() as conn:
+                await conn.execute(
+                    """
+                    INSERT OR IGNORE INTO local_links(long_url, created_at)
+                    VALUES (?,?)
+                    """,
+                    (long_url, time.time()),
+                )
+                rows = await conn.execute_fetchall(
+                    "SELECT id FROM local_links WHERE long_url=?",
+                    (long_url,),
+                )
+        except Exception as e:
+            return f"Ошибка: {e}"
+
+        link_id = rows[0][0]
+        self._remember(link_id, long_url)
+        return f"{self.base_url}/{base62_encode(link_id)}"
+
+    async def resolve(self, code: str):
+        try:
+            link_id = base62_decode(code)
+        except ValueError:
+            return None
+        if link_id > SQLITE_MAX_ID:
+            # Иначе OverflowError при запросе и 500 вместо 404
+            return None
+
+        long_url = self._hot.get(link_id)
+        if long_url is not None:
+            self._hot.move_to_end(link_id)
+            return long_url
+
+        async with links_db.reader() as conn:
+            rows = await conn.execute_fetchall(
+                "SELECT long_url FROM local_links WHERE id=?",
+                (link_id,),
+            )
+        if not rows:
+            return None
+        self._remember(link_id, rows[0][0])
+        return rows[0][0]
+
+    def _remember(self, link_id: int, long_url: str):
+        self._hot[link_id] = long_url
+        self._hot.move_to_end(link_id)
+        while len(self._hot) > LOCAL_LINKS_HOT:
+            self._hot.popitem(last=False)
+
+    async def _redirect(self, request: web.Request):
+        long_url = await self.resolve(request.match_info["code"])
+        if long_url is None:
+            raise web.HTTPNotFound()
+        raise web.HTTPFound(long_url)
+
+    async def start_server(self):
+        app = web.Application()
+        app.router.add_get("/{code}", self._redirect)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, SHORTENER_HOST, SHORTENER_PORT).start()
+        logger.info(f"redirect server on {SHORTENER_HOST}:{SHORTENER_PORT}")
+
+    async def stop_server(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+
+class CircuitBreaker:
+    # closed -> open после failures ошибок подряд -> через cooldown
+    # half-open: пропускается один пробный запрос
+    def __init__(self, failures: int, cooldown: float):
+        self.failures = failures
+        self.cooldown = cooldown
+        self._errors = 0
+        self._opened_at = None
+        self._probing = False
+
+    def available(self) -> bool:
+        # Без побочных эффектов: можно ли сейчас отправить запрос
+        if self._opened_at is None:
+            return True
+        return (
+            not self._probing
+            and time.monotonic() - self._opened_at >= self.cooldown
+        )
+
+    def acquire(self) -> bool:
+        # Вызывается перед реальным запросом; в half-open занимает
+        # единственный пробный слот
+        if not self.available():
+            return False
+        if self._opened_at is not None:
+            self._probing = True
+        return True
+
+    def success(self):
+        self._errors = 0
+        self._opened_at = None
+        self._probing = False
+
+    def failure(self) -> bool:
+        # True, если breaker только что открылся
+        self._errors += 1
+        self._probing = False
+        if self._opened_at is not None or self._errors >= self.failures:
+            was_closed = self._opened_at is None
+            self._opened_at = time.monotonic()
+            return was_closed
+        return False
+
+    def release(self):
+        # Запрос отменён хеджем — не считаем ни успехом, ни ошибкой
+        self._probing = False
+
+
+class PoolMember:
+    def __init__(self, backend):
+        self.backend = backend
+        self.breaker = CircuitBreaker(SHORTENER_FAILURES, SHORTENER_COOLDOWN)
+        self.latencies = deque(maxlen=SHORTENER_LATENCY_WINDOW)
+
+    def hedge_delay(self) -> float:
+        if len(self.latencies) < SHORTENER_HEDGE_SAMPLES:
+            return SHORTENER_HEDGE_DELAY
+        ordered = sorted(self.latencies)
+        p95 = ordered[int(len(ordered) * 0.95) - 1]
+        return max(SHORTENER_HEDGE_MIN, p95)
+
+
+class ShortenerPool:
+    # Сокращатели по приоритету. Следующий запускается, если текущий
+    # ответил ошибкой или молчит дольше своего p95; побеждает первый
+    # успешный ответ, остальные запросы отменяются
+    def __init__(self, backends: list):
+        self.members = [PoolMember(b) for b in backends]
+
+    async def shorten(self, long_url: str) -> str:
+        queue = [m for m in self.members if m.breaker.available()]
+        running = {}
+        last_error = "Ошибка: все сокращатели недоступны"
+        try:
+            self._launch(queue, running, long_url)
+            while running:
+                timeout = None
+                if queue:
+                    timeout = min(m.hedge_delay() for m in running.values())
+                done, _ = await asyncio.wait(
+                    running,
+                    timeout=timeout,
+                    return_when=asyncio.FIRST_COMPLETED,
+                )
+
+                if not done:
+                    # Хедж: текущие запросы не отменяем, добавляем следующий
+                    self._launch(queue, running, long_url)
+                    continue
+
+                for task in done:
+                    del running[task]
+                    short = task.result()
+                    if short.startswith("http"):
+                        return short
+                    last_error = short
+                # Ошибка: следующий запускается сразу, не дожидаясь хеджа
+                self._launch(queue, running, long_url)
+            return last_error
+        finally:
+            for task in running:
+                task.cancel()
+
+    def _launch(self, queue: list, running: dict, long_url: str):
+        # Запускает первого из очереди, чей breaker пропускает запрос
+        while queue:
+            member = queue.pop(0)
+            if not member.breaker.acquire():
+                continue
+            task = asyncio.ensure_future(self._attempt(member, long_url))
+            task.add_done_callback(
+                lambda t, m=member: t.cancelled() and m.breaker.release()
+            )
+            running[task] = member
+            return
+
+    async def _attempt(self, member: PoolMember, long_url: str) -> str:
+        started = time.monotonic()
+        short = await member.backend.shorten(long_url)
+
+        if short.startswith("http"):
+            member.latencies.append(time.monotonic() - started)
+            member.breaker.success()
+        elif member.breaker.failure():
+            logger.warning(
+                f"shortener {member.backend.name} disabled for "
+                f"{SHORTENER_COOLDOWN:.0f}s: {short}"
+            )
+        return short
+
+    async def close(self):
+        for member in self.members:
+            if isinstance(member.backend, LocalBackend):
+                await member.backend.stop_server()
+
+
+class LinkShortener:
+    def __init__(self, backend):
+        self._backend = backend
+        self._cache = LinkCache(LINK_CACHE_SIZE, LINK_CACHE_TTL, LINK_CACHE_DB_ROWS)
+        self._inflight = {}
+
+    async def shorten(self, long_url: str) -> str:
+        key = normalize_url(long_url)
+        short = await self._cache.get(key)
+        if short is not None:
+            return short
+
+        # Одновременные запросы одной ссылки идут одним запросом наружу
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._fetch(key, long_url.strip()))
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        return await asyncio.shield(task)
+
+    async def _fetch(self, key: str, long_url: str) -> str:
+        short = await self._backend.shorten(long_url)
+        if short.startswith("http"):
+            await self._cache.put(key, short)
+        return short
 
 
 # -------------------------------------------------
 # ПОДПИСЧИКИ
 # -------------------------------------------------
-def add_subscriber(chat_id: int):
-    conn = get_conn(DB_SUBS)
-    conn.execute(
-        "INSERT OR IGNORE INTO subscribers(chat_id) VALUES(?)",
-        (chat_id,),
-    )
-    conn.commit()
-    conn.close()
+class SubscriberRegistry:
+    # Множество chat_id в памяти, загружается один раз;
+    # изменения сразу пишутся в subs.db (write-through)
+    def __init__(self):
+        self._ids = set()
+        self._lock = asyncio.Lock()
+
+    async def load(self):
+        async with subs_db.reader() as conn:
+            rows = await conn.execute_fetchall(
+                "SELECT chat_id FROM subscribers"
+            )
+        self._ids = {r[0] for r in rows}
+        logger.info(f"subscribers loaded: {len(self._ids)}")
+
+    async def add(self, chat_id: int):
+        async with self._lock:
+            async with subs_db.writer() as conn:
+                await conn.execute(
+                    "INSERT OR IGNORE INTO subscribers(chat_id) VALUES(?)",
+                    (chat_id,),
+                )
+            self._ids.add(chat_id)
 
+    async def remove(self, chat_id: int):
+        await self.remove_many((chat_id,))
 
-def remove_subscriber(chat_id: int):
-    conn = get_conn(DB_SUBS)
-    conn.execute(
-        "DELETE FROM subscribers WHERE chat_id=?",
-        (chat_id,),
-    )
-    conn.commit()
-    conn.close()
+    async def remove_many(self, chat_ids):
+        async with self._lock:
+            async with subs_db.writer() as conn:
+                await conn.executemany(
+                    "DELETE FROM subscribers WHERE chat_id=?",
+                    [(chat_id,) for chat_id in chat_ids],
+                )
+            self._ids.difference_update(chat_ids)
 
+    def snapshot(self):
+        # Неизменяемая копия: рассылка не видит правок посреди обхода
+        return tuple(self._ids)
 
-def get_subscribers():
-    conn = get_conn(DB_SUBS)
-    rows = conn.execute(
-        "SELECT chat_id FROM subscribers"
-    ).fetchall()
-    conn.close()
-    return [r[0] for r in rows]
+    def __len__(self):
+        return len(self._ids)
+
+
+subscribers = SubscriberRegistry()
 
 
 # -------------------------------------------------
 # SAFE SEND
 # -------------------------------------------------
-async def send_safe(bot: Bot, chat_id: int, text: str):
-    try:
-        if len(text) > MAX_MESSAGE_LENGTH:
-            text = text[:MAX_MESSAGE_LENGTH]
-        await bot.send_message(chat_id, text)
-    except TelegramRetryAfter as e:
-        await asyncio.sleep(e.retry_after)
-        await send_safe(bot, chat_id, text)
-    except Exception as e:
-        logger.error(f"send_safe error: {e}")
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float = 1.0):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(
+                    self.capacity,
+                    self.tokens + (now - self.updated) * self.rate,
+                )
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class SendGovernor:
+    # Лимиты Telegram: ~30 сообщений/с на бота и ~1/с в один чат.
+    # RetryAfter на любом запросе ставит на паузу все отправки сразу.
+    def __init__(self, global_rate: float, chat_rate: float, concurrency: int):
+        self.chat_rate = chat_rate
+        self.chat_rates = {}
+        # Ёмкость 1: после простоя не выпускаем пачку сверх общего лимита
+        self._global = TokenBucket(global_rate)
+        self._chats = {}
+        self._inflight = asyncio.Semaphore(concurrency)
+        self._resume_at = 0.0
+
+    def pause(self, seconds: float):
+        resume_at = time.monotonic() + seconds
+        if resume_at > self._resume_at:
+            self._resume_at = resume_at
+            logger.warning(f"flood control: all sends paused for {seconds}s")
+
+    async def _wait_resume(self):
+        while True:
+            delay = self._resume_at - time.monotonic()
+            if delay <= 0:
+                return
+            # Разброс, чтобы после паузы не ударить в API всем разом
+            await asyncio.sleep(delay + random.uniform(0, SEND_RETRY_JITTER))
+
+    @asynccontextmanager
+    async def slot(self, chat_id: int):
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            rate = self.chat_rates.get(chat_id, self.chat_rate)
+            bucket = self._chats[chat_id] = TokenBucket(rate)
+        # Сначала ждём свой чат, чтобы не занимать общий лимит впустую
+        await bucket.acquire()
+        await self._global.acquire()
+        async with self._inflight:
+            await self._wait_resume()
+            yield
+
+
+send_governor = SendGovernor(SEND_GLOBAL_RATE, SEND_CHAT_RATE, SEND_CONCURRENCY)
+if BROADCAST_CHAT_ID:
+    # В группы и каналы — не больше ~20 сообщений в минуту
+    send_governor.chat_rates[BROADCAST_CHAT_ID] = BROADCAST_CHAT_RATE
+
+
+@lru_cache(maxsize=256)
+def split_message(text: str):
+    # Режем по строкам, длинные строки — по " | ", и только потом по символам.
+    # Кэш: одно и то же сообщение для всех подписчиков режется один раз.
+    if len(text) <= MAX_MESSAGE_LENGTH:
+        return (text,)
+
+    limit = MAX_MESSAGE_LENGTH - CHUNK_MARKER_RESERVE
+    chunks = []
+    cur = ""
+
+    def add(piece: str, sep: str):
+        nonlocal cur
+        if cur and len(cur) + len(sep) + len(piece) <= limit:
+            cur += sep + piece
+            return
+        if cur:
+            chunks.append(cur)
+        while len(piece) > limit:
+            chunks.append(piece[:limit])
+            piece = piece[limit:]
+        cur = piece
+
+    for line in text.split("\n"):
+        if len(line) <= limit:
+            add(line, "\n")
+            continue
+        for i, part in enumerate(line.split(" | ")):
+            add(part, " | " if i else "\n")
+    if cur:
+        chunks.append(cur)
+
+    n = len(chunks)
+    return tuple(f"{chunk}\n({i}/{n})" for i, chunk in enumerate(chunks, start=1))
+
+
+# Итог отправки
+SEND_OK = "ok"
+SEND_RETRY = "retry"  # временная ошибка, повторим позже
+SEND_DROP = "drop"  # сообщение не пройдёт никогда, чат жив
+SEND_DEAD = "dead"  # чат недоступен навсегда
+
+DEAD_CHAT_ERRORS = (
+    "chat not found",
+    "user is deactivated",
+    "peer_id_invalid",
+    "bot was kicked",
+    "bot was blocked",
+)
+
+
+def classify_send_error(e: Exception) -> str:
+    if isinstance(e, TelegramForbiddenError):
+        return SEND_DEAD
+    if isinstance(e, TelegramBadRequest):
+        text = str(e).lower()
+        if any(err in text for err in DEAD_CHAT_ERRORS):
+            return SEND_DEAD
+        # Правка тем же текстом — цель достигнута
+        if "message is not modified" in text:
+            return SEND_OK
+        return SEND_DROP
+    return SEND_RETRY
+
+
+async def call_safe(chat_id: int, request):
+    # request — фабрика корутины, чтобы повторять запрос после RetryAfter
+    for _ in range(SEND_MAX_RETRIES + 1):
+        try:
+            async with send_governor.slot(chat_id):
+                return SEND_OK, await request()
+        except TelegramRetryAfter as e:
+            send_governor.pause(e.retry_after)
+        except Exception as e:
+            status = classify_send_error(e)
+            if status != SEND_OK:
+                logger.error(f"send_safe error ({status}): {e}")
+            return status, None
+
+    logger.error(f"send_safe: {chat_id} still rate limited, giving up")
+    return SEND_RETRY, None
+
+
+async def send_safe(bot: Bot, chat_id: int, text: str, skip: int = 0):
+    # -> (статус, id отправленных сообщений);
+    # skip — сколько частей уже доставлено прошлыми попытками
+    sent = []
+    for chunk in split_message(text)[skip:]:
+        status, msg = await call_safe(
+            chat_id, lambda: bot.send_message(chat_id, chunk)
+        )
+        if status != SEND_OK:
+            return status, sent
+        sent.append(msg.message_id)
+    return SEND_OK, sent
+
+
+async def edit_safe(bot: Bot, chat_id: int, message_id: int, text: str) -> str:
+    status, _ = await call_safe(
+        chat_id,
+        lambda: bot.edit_message_text(
+            text=text, chat_id=chat_id, message_id=message_id
+        ),
+    )
+    return status
 
 
 # -------------------------------------------------
 # POLLING GOOGLE SHEETS
 # -------------------------------------------------
-async def poll_loop(bot: Bot):
-    global FIRST_RUN
+class RowHashIndex:
+    # row_index -> хеш строки, плотный массив дайджестов фиксированной
+    # ширины; нулевой дайджест — строки нет.
+    # Здесь же хеши блоков и корень дерева из order_blocks/meta.
+    def __init__(self, width: int):
+        self.width = width
+        self._buf = bytearray()
+        self._empty = bytes(width)
+        self.max_row = 0
+        self.blocks = {}
+        self.root = None
+
+    def get(self, idx: int):
+        off = idx * self.width
+        digest = bytes(self._buf[off:off + self.width])
+        if not digest or digest == self._empty:
+            return None
+        return digest
+
+    def set(self, idx: int, digest: bytes):
+        off = idx * self.width
+        end = off + self.width
+        if end > len(self._buf):
+            self._buf.extend(bytes(end - len(self._buf)))
+        self._buf[off:end] = digest
+        self.max_row = max(self.max_row, idx)
+
+    def apply(self, changes: "ChangeSet"):
+        for idx, digest in changes.digests():
+            self.set(idx, digest)
+        if changes.root is not None:
+            self.blocks.update(changes.blocks)
+            for block in [b for b in self.blocks if b >= changes.block_count]:
+                del self.blocks[block]
+            self.root = changes.root
+
+    async def load(self):
+        async with orders_db.reader() as conn:
+            async with conn.execute("SELECT row_index, hash FROM orders") as cur:
+                async for idx, h in cur:
+                    self.set(idx, h)
+            self.blocks = dict(
+                await conn.execute_fetchall(
+                    "SELECT block_index, digest FROM order_blocks"
+                )
+            )
+            res = await conn.execute_fetchall(
+                "SELECT value FROM meta WHERE key='merkle_root'"
+            )
+            self.root = res[0][0] if res else None
+        logger.info(f"row hash index loaded: {self.max_row} rows")
 
-    while True:
-        try:
-            ws = get_sheet()
-            rows = ws.get_all_values()
 
-            conn = get_conn(DB_ORDERS)
-            c = conn.cursor()
+row_hashes = RowHashIndex(DIGEST_SIZE)
 
-            for idx, row in enumerate(rows, start=1):
-                if not any(row):
-                    continue
 
-                line = make_line(row)
-                if not line:
-                    continue
+def last_row_index() -> int:
+    return row_hashes.max_row
 
-                h = make_hash(line)
 
-                c.execute(
-                    "SELECT hash FROM orders WHERE row_index=?",
-                    (idx,),
-                )
-                res = c.fetchone()
+def row_lines(rows):
+    return [make_line(row) if any(row) else "" for row in rows]
 
-                if res is None:
-                    c.execute(
-                        "INSERT INTO orders(row_index, hash, line) VALUES(?,?,?)",
-                        (idx, h, line),
-                    )
-                    if not FIRST_RUN:
-                        c.execute(
-                            """
-                            INSERT OR REPLACE INTO pending
-                            (row_index, hash, line, ts, is_new)
-                            VALUES (?,?,?,?,1)
-                            """,
-                            (idx, h, line, time.time()),
-                        )
-                elif res[0] != h:
-                    c.execute(
-                        """
-                        UPDATE orders
-                        SET hash=?, line=?, updated_at=strftime('%s','now')
-                        WHERE row_index=?
-                        """,
-                        (h, line, idx),
-                    )
-                    c.execute(
-                        """
-                        INSERT OR REPLACE INTO pending
-                        (row_index, hash, line, ts, is_new)
-                        VALUES (?,?,?,?,0)
-                        """,
-                        (idx, h, line, time.time()),
-                    )
 
-            conn.commit()
-            conn.close()
+def block_digest(lines, start: int) -> bytes:
+    h = new_digest()
+    for idx, line in enumerate(lines, start=start):
+        if line:
+            data = line.encode("utf-8")
+            h.update(f"{idx}:{len(data)}:".encode())
+            h.update(data)
+    return h.digest()
 
-            await notify_subscribers(bot)
+
+class ChangeSet:
+    def __init__(self):
+        self.inserts = []
+        self.updates = []
+        self.pending = []
+        # Изменившиеся блоки дерева хешей (только для полной сверки)
+        self.blocks = []
+        self.block_count = 0
+        self.root = None
+
+    def __bool__(self):
+        return bool(
+            self.inserts or self.updates or self.pending
+            or self.root is not None
+        )
+
+    def extend(self, other: "ChangeSet"):
+        self.inserts += other.inserts
+        self.updates += other.updates
+        self.pending += other.pending
+
+    def digests(self):
+        for idx, h, _ in self.inserts:
+            yield idx, h
+        for h, _, idx in self.updates:
+            yield idx, h
+
+    async def apply(self, conn: aiosqlite.Connection):
+        await conn.executemany(
+            "INSERT INTO orders(row_index, hash, line) VALUES(?,?,?)",
+            self.inserts,
+        )
+        await conn.executemany(
+            """
+            UPDATE orders
+            SET hash=?, line=?, updated_at=strftime('%s','now')
+            WHERE row_index=?
+            """,
+            self.updates,
+        )
+        await conn.executemany(
+            """
+            INSERT OR REPLACE INTO pending
+            (row_index, hash, line, ts, is_new)
+            VALUES (?,?,?,?,?)
+            """,
+            self.pending,
+        )
+        if self.root is not None:
+            await conn.executemany(
+                "INSERT OR REPLACE INTO order_blocks(block_index, digest) VALUES(?,?)",
+                self.blocks,
+            )
+            await conn.execute(
+                "DELETE FROM order_blocks WHERE block_index >= ?",
+                (self.block_count,),
+            )
+            await conn.execute(
+                "INSERT OR REPLACE INTO meta(key, value) VALUES('merkle_root', ?)",
+                (self.root,),
+            )
+
+
+def diff_lines(lines, start: int, first_run: bool) -> ChangeSet:
+    changes = ChangeSet()
+    now = time.time()
+
+    for idx, line in enumerate(lines, start=start):
+        if not line:
+            continue
+
+        h = make_hash(line)
+        old = row_hashes.get(idx)
+
+        if old is None:
+            changes.inserts.append((idx, h, line))
+            if not first_run:
+                changes.pending.append((idx, h, line, now, 1))
+        elif old != h:
+            changes.updates.append((h, line, idx))
+            changes.pending.append((idx, h, line, now, 0))
+
+    return changes
+
+
+def diff_blocks(lines, first_run: bool) -> ChangeSet:
+    # Дерево хешей: корень -> блоки по MERKLE_BLOCK_ROWS строк -> строки.
+    # В строки спускаемся только для блоков с изменившимся хешем.
+    size = MERKLE_BLOCK_ROWS
+    digests = [
+        block_digest(lines[i:i + size], i + 1)
+        for i in range(0, len(lines), size)
+    ]
+    root = new_digest(b"".join(digests)).digest()
+
+    changes = ChangeSet()
+    if root == row_hashes.root:
+        return changes
+
+    for block, digest in enumerate(digests):
+        if row_hashes.blocks.get(block) != digest:
+            i = block * size
+            changes.extend(diff_lines(lines[i:i + size], i + 1, first_run))
+            changes.blocks.append((block, digest))
+
+    changes.block_count = len(digests)
+    changes.root = root
+    return changes
+
+
+def diff_snapshot(rows, first_run: bool, start: int) -> ChangeSet:
+    lines = row_lines(rows)
+    if start == 1:
+        return diff_blocks(lines, first_run)
+    # Хвост не покрывает блоки целиком — их хеши обновит полная сверка
+    return diff_lines(lines, start, first_run)
+
+
+# Разбор и сравнение листа идут в отдельном пуле,
+# чтобы диспетчер aiogram не простаивал на больших листах
+SHEETS_EXECUTOR = ThreadPoolExecutor(
+    max_workers=SHEETS_WORKERS,
+    thread_name_prefix="sheets",
+)
+sheets_semaphore = asyncio.Semaphore(SHEETS_CONCURRENCY)
+
+
+async def ingest_rows(rows, first_run: bool, start: int = 1):
+    loop = asyncio.get_running_loop()
+    changes = await loop.run_in_executor(
+        SHEETS_EXECUTOR, diff_snapshot, rows, first_run, start
+    )
+    if not changes:
+        return
+
+    # Все изменения цикла пишутся пачками в одной транзакции
+    async with orders_db.writer() as conn:
+        await changes.apply(conn)
+
+    # Индекс в памяти меняем только после успешного коммита
+    row_hashes.apply(changes)
+
+
+async def sheet_changed(sheets: SheetsClient):
+    # Дешёвая проверка через Drive: (changed, version)
+    if not CHANGE_DETECTION:
+        return True, None
+    try:
+        version = await sheets.file_version()
+    except Exception as e:
+        sheets.handle_error(e)
+        logger.warning(f"sheet version check failed: {e}")
+        return True, None
+    return version != SHEET_VERSION, version
+
+
+async def fetch_tail(sheets: SheetsClient, start: int):
+    try:
+        return await sheets.values_get(f"A{start}:{LAST_COL}")
+    except aiohttp.ClientResponseError as e:
+        # 400 — диапазон за пределами сетки листа, новых строк нет
+        if e.status == 400:
+            return []
+        raise
+
+
+async def run_ingest(sheets: SheetsClient, first_run: bool):
+    global SHEET_VERSION, TAIL_CYCLES
+
+    if TAIL_MODE:
+        TAIL_CYCLES += 1
+    full = first_run or not TAIL_MODE or TAIL_CYCLES >= FULL_SYNC_EVERY
+
+    # Версия, обработанная проходом по хвосту, могла включать правки
+    # старых строк, поэтому плановая сверка идёт без проверки версии
+    changed, version = await sheet_changed(sheets)
+    if not changed and not (TAIL_MODE and full):
+        return
+
+    if not full:
+        start = last_row_index() + 1
+        async with sheets_semaphore:
+            rows = await fetch_tail(sheets, start)
+        if version is not None and not any(any(r) for r in rows):
+            # Таблица изменилась, а новых строк нет — правили старые
+            full = True
+
+    if full:
+        start = 1
+        async with sheets_semaphore:
+            rows = await sheets.values_get(f"A1:{LAST_COL}")
+        TAIL_CYCLES = 0
+
+    await ingest_rows(rows, first_run, start)
+
+    SHEET_VERSION = version
+
+
+async def poll_loop(sheets: SheetsClient):
+    global FIRST_RUN
+
+    while True:
+        try:
+            await run_ingest(sheets, FIRST_RUN)
+            await enqueue_pending()
 
         except Exception as e:
+            sheets.handle_error(e)
             logger.exception("poll_loop error")
 
         if FIRST_RUN:
@@ -272,47 +1463,336 @@ async def poll_loop(bot: Bot):
 # -------------------------------------------------
 # УВЕДОМЛЕНИЯ
 # -------------------------------------------------
-async def notify_subscribers(bot: Bot):
-    conn = get_conn(DB_ORDERS)
-    c = conn.cursor()
-
-    rows = c.execute(
-        """
-        SELECT row_index, line, is_new
-        FROM pending
-        WHERE ts <= ?
-        """,
-        (time.time() - NOTIFY_DELAY,),
-    ).fetchall()
-
-    subs = get_subscribers()
-
-    for row_index, line, is_new in rows:
-        msg = (
-            "🆕 Новый заказ:\n" + line
-            if is_new
-            else "♻ Обновлён заказ:\n" + line
+def format_order(line: str, is_new: bool) -> str:
+    if is_new:
+        return "🆕 Новый заказ:\n" + line
+    return "♻ Обновлён заказ:\n" + line
+
+
+def delivery_targets():
+    # dm — личные сообщения подписчикам, channel — один пост в канал,
+    # hybrid — пост в канал плюс личные сообщения подписчикам
+    if DELIVERY_MODE == "channel":
+        return (BROADCAST_CHAT_ID,)
+    if DELIVERY_MODE == "hybrid":
+        return (BROADCAST_CHAT_ID,) + subscribers.snapshot()
+    return subscribers.snapshot()
+
+
+async def enqueue_pending():
+    # Созревшие pending -> задания outbox (заказ, подписчик)
+    async with orders_db.reader() as conn:
+        rows = await conn.execute_fetchall(
+            """
+            SELECT row_index, hash, line, is_new
+            FROM pending
+            WHERE ts <= ?
+            """,
+            (time.time() - NOTIFY_DELAY,),
+        )
+    if not rows:
+        return
+
+    targets = delivery_targets()
+    now = time.time()
+    jobs = [
+        (row_index, chat_id, h, line, is_new, now)
+        for row_index, h, line, is_new in rows
+        for chat_id in targets
+    ]
+
+    async with orders_db.writer() as conn:
+        # Неотправленное задание заменяется свежей версией строки,
+        # но пометка «новый» не теряется. Новая версия шлётся целиком
+        await conn.executemany(
+            """
+            INSERT INTO outbox (row_index, chat_id, hash, line, is_new, ts)
+            VALUES (?,?,?,?,?,?)
+            ON CONFLICT(row_index, chat_id) DO UPDATE SET
+                parts_sent=CASE WHEN hash=excluded.hash THEN parts_sent ELSE 0 END,
+                hash=excluded.hash,
+                line=excluded.line,
+                is_new=MAX(is_new, excluded.is_new),
+                ts=excluded.ts
+            """,
+            jobs,
+        )
+        # Если строку успели снова изменить, новая версия остаётся в очереди
+        await conn.executemany(
+            "DELETE FROM pending WHERE row_index=? AND hash=?",
+            [(row_index, h) for row_index, h, _, _ in rows],
+        )
+
+
+def retry_delay(attempts: int) -> float:
+    delay = min(DELIVERY_RETRY_BASE * 2 ** (attempts - 1), DELIVERY_RETRY_MAX)
+    return delay * random.uniform(0.8, 1.2)
+
+
+def pack_jobs(jobs):
+    # Несколько заказов в одном сообщении, пока влезают в MAX_MESSAGE_LENGTH
+    if not BATCH_MESSAGES:
+        return [[job] for job in jobs]
+
+    packs = []
+    pack = []
+    size = 0
+    for job in jobs:
+        n = len(format_order(job[2], job[3]))
+        if pack and size + len(PACK_SEPARATOR) + n > MAX_MESSAGE_LENGTH:
+            packs.append(pack)
+            pack = []
+            size = 0
+        if pack:
+            size += len(PACK_SEPARATOR)
+        size += n
+        pack.append(job)
+    if pack:
+        packs.append(pack)
+    return packs
+
+
+async def recent_messages(by_chat: dict):
+    # chat_id -> {row_index -> (message_id, is_new)} для сообщений,
+    # которые ещё можно править; один запрос на весь проход доставки
+    if not EDIT_WINDOW:
+        return {}
+    updated = sorted({
+        job[0] for jobs in by_chat.values() for job in jobs if not job[3]
+    })
+    if not updated:
+        return {}
+    async with orders_db.reader() as conn:
+        rows = await conn.execute_fetchall(
+            f"""
+            SELECT chat_id, row_index, message_id, is_new
+            FROM sent_messages
+            WHERE sent_at>=? AND row_index IN ({",".join("?" * len(updated))})
+            """,
+            (time.time() - EDIT_WINDOW, *updated),
         )
+    recent = {}
+    for chat_id, row_index, mid, is_new in rows:
+        if chat_id in by_chat:
+            recent.setdefault(chat_id, {})[row_index] = (mid, is_new)
+    return recent
+
+
+async def deliver_pack(bot: Bot, chat_id: int, pack, recent):
+    # -> (статус, запись для sent_messages или None, доставлено частей)
+    if len(pack) == 1:
+        row_index, _, line, is_new, _, _ = pack[0]
+        prev = recent.get(row_index)
+        if prev is not None and not is_new:
+            message_id, was_new = prev
+            text = format_order(line, was_new)
+            if len(split_message(text)) == 1:
+                status = await edit_safe(bot, chat_id, message_id, text)
+                # DROP — сообщение удалено или слишком старое, шлём новое
+                if status != SEND_DROP:
+                    return status, None, 0
+
+    text = PACK_SEPARATOR.join(
+        format_order(line, is_new) for _, _, line, is_new, _, _ in pack
+    )
+    # Длиннее одного сообщения бывает только пакет из одного заказа:
+    # после сбоя продолжаем с первой недоставленной части
+    skip = pack[0][5] if len(pack) == 1 else 0
+    status, sent = await send_safe(bot, chat_id, text, skip)
+
+    # Править можно только сообщение с одним заказом целиком
+    record = None
+    if (
+        status == SEND_OK and EDIT_WINDOW and len(pack) == 1
+        and skip == 0 and len(sent) == 1
+    ):
+        row_index, _, _, is_new, _, _ = pack[0]
+        record = (row_index, chat_id, sent[0], is_new, time.time())
+    return status, record, skip + len(sent)
+
+
+async def send_to_chat(bot: Bot, chat_id: int, jobs, dead: set, recent: dict):
+    # В пределах одного чата порядок сообщений сохраняется:
+    # после неудачи остальные задания чата ждут вместе с ней
+    packs = pack_jobs(jobs)
+    for i, pack in enumerate(packs):
+        status, record, parts = await deliver_pack(bot, chat_id, pack, recent)
+
+        if status == SEND_DEAD and chat_id == BROADCAST_CHAT_ID:
+            # Канал не вычёркиваем: скорее всего у бота отобрали права
+            logger.error(f"broadcast chat {chat_id} is unavailable")
+            status = SEND_RETRY
+        elif status == SEND_DEAD:
+            dead.add(chat_id)
+            return
 
-        for chat_id in subs:
-            await send_safe(bot, chat_id, msg)
+        if status in (SEND_OK, SEND_DROP):
+            if status == SEND_DROP:
+                logger.error(f"dropping undeliverable message for {chat_id}")
+            # Отмечаем доставку сразу, чтобы после рестарта не слать повторно.
+            # Задание, обновлённое во время отправки, остаётся в outbox.
+            async with orders_db.writer() as conn:
+                await conn.executemany(
+                    "DELETE FROM outbox WHERE row_index=? AND chat_id=? AND hash=?",
+                    [(job[0], chat_id, job[1]) for job in pack],
+                )
+                if record is not None:
+                    await conn.execute(
+                        """
+                        INSERT OR REPLACE INTO sent_messages
+                        (row_index, chat_id, message_id, is_new, sent_at)
+                        VALUES (?,?,?,?,?)
+                        """,
+                        record,
+                    )
+            continue
 
-        c.execute(
-            "DELETE FROM pending WHERE row_index=?",
-            (row_index,),
+        attempts = max(job[4] for job in pack) + 1
+        next_at = time.time() + retry_delay(attempts)
+        logger.warning(
+            f"delivery to {chat_id} failed "
+            f"({len(pack)} orders from row {pack[0][0]}, attempt {attempts})"
         )
+        async with orders_db.writer() as conn:
+            await conn.executemany(
+                "UPDATE outbox SET attempts=? WHERE row_index=? AND chat_id=?",
+                [(attempts, job[0], chat_id) for job in pack],
+            )
+            await conn.executemany(
+                "UPDATE outbox SET next_at=? WHERE row_index=? AND chat_id=?",
+                [(next_at, job[0], chat_id) for p in packs[i:] for job in p],
+            )
+            if len(pack) == 1 and parts:
+                # Если строку успели изменить, новая версия пойдёт целиком
+                await conn.execute(
+                    """
+                    UPDATE outbox SET parts_sent=?
+                    WHERE row_index=? AND chat_id=? AND hash=?
+                    """,
+                    (parts, pack[0][0], chat_id, pack[0][1]),
+                )
+        return
 
-    conn.commit()
-    conn.close()
+
+async def notify_subscribers(bot: Bot):
+    async with orders_db.reader() as conn:
+        rows = await conn.execute_fetchall(
+            """
+            SELECT chat_id, row_index, hash, line, is_new, attempts, parts_sent
+            FROM outbox
+            WHERE next_at <= ?
+            ORDER BY row_index, chat_id
+            LIMIT ?
+            """,
+            (time.time(), DELIVERY_BATCH),
+        )
+    if not rows:
+        return
+
+    # Пачка идёт по заказам, а не по чатам: так она задевает много чатов
+    # сразу и проход не упирается в лимит одного чата
+    by_chat = {}
+    for chat_id, *job in rows:
+        by_chat.setdefault(chat_id, []).append(job)
+
+    recent = await recent_messages(by_chat)
+    dead = set()
+    # Ошибка одного чата не должна завершать проход, пока остальные
+    # ещё отправляют: иначе следующий проход повторит их задания
+    results = await asyncio.gather(
+        *(
+            send_to_chat(bot, chat_id, jobs, dead, recent.get(chat_id, {}))
+            for chat_id, jobs in by_chat.items()
+        ),
+        return_exceptions=True,
+    )
+    for chat_id, result in zip(by_chat, results):
+        if isinstance(result, Exception):
+            logger.error(f"delivery to {chat_id} failed: {result!r}")
+    if dead:
+        await prune_dead_chats(dead)
+
+    if EDIT_WINDOW:
+        async with orders_db.writer() as conn:
+            await conn.execute(
+                "DELETE FROM sent_messages WHERE sent_at < ?",
+                (time.time() - EDIT_WINDOW,),
+            )
+
+
+async def drop_chat_jobs(chat_ids) -> int:
+    # Очередь и история сообщений ушедших чатов; -> сколько заданий снято
+    async with orders_db.writer() as conn:
+        cur = await conn.executemany(
+            "DELETE FROM outbox WHERE chat_id=?",
+            [(chat_id,) for chat_id in chat_ids],
+        )
+        dropped = cur.rowcount
+        await conn.executemany(
+            "DELETE FROM sent_messages WHERE chat_id=?",
+            [(chat_id,) for chat_id in chat_ids],
+        )
+    return dropped
+
+
+async def prune_dead_chats(dead: set):
+    total = len(subscribers)
+    await subscribers.remove_many(dead)
+    dropped = await drop_chat_jobs(dead)
+
+    share = len(dead) / total if total else 1.0
+    logger.info(
+        f"pruned {len(dead)} dead chats: {share:.1%} of {total} subscribers, "
+        f"{dropped} queued sends dropped; each broadcast now needs "
+        f"{len(dead)} fewer requests"
+    )
+
+
+async def delivery_loop(bot: Bot):
+    while True:
+        try:
+            await notify_subscribers(bot)
+        except Exception:
+            logger.exception("delivery_loop error")
+
+        await asyncio.sleep(DELIVERY_INTERVAL)
 
 
 # -------------------------------------------------
 # MAIN
 # -------------------------------------------------
 async def main():
-    init_db_orders()
-    init_db_subs()
-
+    if DELIVERY_MODE != "dm" and not BROADCAST_CHAT_ID:
+        logger.error(f"DELIVERY_MODE={DELIVERY_MODE} requires BROADCAST_CHAT_ID")
+        return
+    unknown = [
+        b for b in SHORTENER_BACKENDS
+        if b != "local" and b not in HTTP_SHORTENERS
+    ]
+    if unknown or not SHORTENER_BACKENDS:
+        logger.error(f"Bad SHORTENER_BACKENDS: {SHORTENER_BACKENDS}")
+        return
+    if "local" in SHORTENER_BACKENDS and not SHORTENER_BASE_URL:
+        logger.error("SHORTENER_BACKENDS=local requires SHORTENER_BASE_URL")
+        return
+
+    await init_db_orders()
+    await init_db_subs()
+    await init_db_links()
+    await row_hashes.load()
+    await subscribers.load()
+
+    http = create_http_session()
+    backends = []
+    for name in SHORTENER_BACKENDS:
+        if name == "local":
+            backend = LocalBackend(SHORTENER_BASE_URL)
+            await backend.start_server()
+        else:
+            backend = HttpBackend(name, http)
+        backends.append(backend)
+    pool = ShortenerPool(backends)
+    shortener = LinkShortener(pool)
     bot = Bot(BOT_TOKEN)
     dp = Dispatcher()
 
@@ -324,6 +1804,38 @@ async def main():
         resize_keyboard=True,
     )
 
+    async def join_channel(msg: types.Message):
+        # Одноразовая ссылка-приглашение в канал рассылки
+        try:
+            link = await bot.create_chat_invite_link(
+                BROADCAST_CHAT_ID,
+                member_limit=1,
+                expire_date=int(time.time()) + INVITE_LINK_TTL,
+            )
+        except Exception as e:
+            logger.error(f"create_chat_invite_link error: {e}")
+            await msg.answer("⚠ Не удалось выдать приглашение, попробуйте позже.")
+            return
+        kb = InlineKeyboardMarkup(
+            inline_keyboard=[
+                [InlineKeyboardButton(text="Вступить в канал", url=link.invite_link)]
+            ]
+        )
+        await msg.answer("✅ Заказы публикуются в канале:", reply_markup=kb)
+
+    async def leave_channel(msg: types.Message):
+        # ban + unban: пользователь удалён, но сможет вернуться по приглашению
+        try:
+            await bot.ban_chat_member(BROADCAST_CHAT_ID, msg.from_user.id)
+            await bot.unban_chat_member(
+                BROADCAST_CHAT_ID, msg.from_user.id, only_if_banned=True
+            )
+        except Exception as e:
+            logger.error(f"leave_channel error: {e}")
+            await msg.answer("⚠ Не удалось отписать, попробуйте позже.")
+            return
+        await msg.answer("❌ Вы отписались.", reply_markup=keyboard)
+
     @dp.message(Command("start"))
     async def start_cmd(msg: types.Message):
         await msg.answer(
@@ -340,17 +1852,25 @@ async def main():
             return
 
         if text == "Подписаться на рассылку":
-            add_subscriber(msg.from_user.id)
+            if DELIVERY_MODE == "channel":
+                await join_channel(msg)
+                return
+            await subscribers.add(msg.from_user.id)
             await msg.answer("✅ Вы подписаны!", reply_markup=keyboard)
             return
 
         if text == "Отписаться от рассылки":
-            remove_subscriber(msg.from_user.id)
+            if DELIVERY_MODE == "channel":
+                await leave_channel(msg)
+                return
+            await subscribers.remove(msg.from_user.id)
+            # Уже поставленные в очередь заказы ему больше не шлём
+            await drop_chat_jobs((msg.from_user.id,))
             await msg.answer("❌ Вы отписались.", reply_markup=keyboard)
             return
 
         if is_url(text):
-            short = shorten_clck(text)
+            short = await shortener.shorten(text)
             if short.startswith("http"):
                 kb = InlineKeyboardMarkup(
                     inline_keyboard=[
@@ -369,8 +1889,18 @@ async def main():
             else:
                 await msg.answer(f"⚠ Не удалось сократить ссылку:\n{short}")
 
-    asyncio.create_task(poll_loop(bot))
-    await dp.start_polling(bot)
+    sheets = SheetsClient(http)
+
+    asyncio.create_task(poll_loop(sheets))
+    asyncio.create_task(delivery_loop(bot))
+    try:
+        await dp.start_polling(bot)
+    finally:
+        await pool.close()
+        await http.close()
+        await orders_db.close()
+        await subs_db.close()
+        await links_db.close()
 
 
 if __name__ == "__main__":